@@ -1,43 +1,76 @@
 import os
+import concurrent.futures
 import subprocess
 import uuid
 import pathlib,shutil,json
-import subprocess
+import math
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _has_non_finite(obj):
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(k) or _has_non_finite(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(v) for v in obj)
+    return False
+
+def _dumps(d):
+    # prm.jsonは常に区切りに空白を入れないASCIIのみのJSONで書く (ロケールのエンコーディングでも読める)
+    # orjsonはNaN/Infinityをnullに変え、64bitを超える整数では例外になり、非ASCIIはそのまま出すので、
+    # そうなる場合は標準のjsonで同じ形式に書き直して値を落とさない
+    if orjson is not None and not _has_non_finite(d):
+        try:
+            out = orjson.dumps(d, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+        else:
+            if out.isascii():
+                return out
+    return json.dumps(d, separators=(",", ":")).encode("ascii")
 
 def get_file_diff(file_path):
     """
     指定したファイルに対する最新のdiffを取得する関数
     """
-    try:
-        git_diff = subprocess.check_output(['git', 'diff',"HEAD",file_path]).decode('utf-8').strip()
-    except subprocess.CalledProcessError:
-        git_diff = "unknown"
-    return git_diff
+    result = subprocess.run(['git', 'diff',"HEAD",file_path], capture_output=True, text=True, encoding="utf-8")
+    if result.returncode != 0:
+        return "unknown"
+    return result.stdout.strip()
 
 def get_git_hash():
     """
     Gitのハッシュを取得する関数
     """
-    try:
-        git_hash = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('utf-8').strip()
-    except subprocess.CalledProcessError:
-        git_hash = "unknown"
-    return git_hash
+    result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, encoding="utf-8")
+    if result.returncode != 0:
+        return "unknown"
+    return result.stdout.strip()
 
 
 def git_commit_all_unstaged(commit_message,experimentBranch = "experiments"):
-    # 現在の作業ディレクトリの状況をすべて検出
-    result = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True)
-    
-    if result.stdout.strip():
-        # 現在のブランチを取得
-        current_branch_result = subprocess.run(["git", "branch", "--show-current"], capture_output=True, text=True)
-        current_branch = current_branch_result.stdout.strip()
-        
+    # 現在の作業ディレクトリの状況と現在のブランチを一度に取得
+    # 出力はデコードせずbytesのまま見る。ヘッダ行は先頭に並ぶので、変更行が一つ見つかれば打ち切る
+    # (`git diff --quiet` では未追跡ファイルを検出できないのでstatusを使う)
+    result = subprocess.run(["git", "status", "--porcelain=v2", "--branch"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    current_branch = None
+    changed = False
+    for line in result.stdout.split(b"\n"):
+        if line.startswith(b"# branch.head "):
+            current_branch = line[len(b"# branch.head "):].decode("utf-8", "replace")
+        elif line and not line.startswith(b"#"):
+            changed = True
+            break
+
+    if changed:
         # 1. 現在の変更をその場でコミット
         subprocess.run(["git", "add", "-A"], check=True)
         subprocess.run(["git", "commit", "-m", commit_message], check=True)
-        
+
         # 2. experimentsブランチの安全な更新
         if current_branch == experimentBranch:
             # 既にexperimentsブランチにいる場合は何もしない
@@ -45,7 +78,7 @@ def git_commit_all_unstaged(commit_message,experimentBranch = "experiments"):
         else:
             # 別のブランチにいる場合は、experimentsブランチを現在のHEADに強制移動
             subprocess.run(["git", "branch", "-f", experimentBranch, "HEAD"], check=True)
-            
+
             # 3. experimentsブランチに切り替え
             subprocess.run(["git", "checkout", experimentBranch], check=True)
     else:
@@ -54,48 +87,91 @@ def git_commit_all_unstaged(commit_message,experimentBranch = "experiments"):
 # 使用例
 # git_commit_all_unstaged("すべての変更をコミットします")
 import stat
+_READONLY_FILE_MODE = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+_READONLY_DIR_MODE = _READONLY_FILE_MODE | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
 def make_readonly_recursive(directory):
-    # ディレクトリ以下を再帰的に処理
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            # 読み取り専用に変更
-            os.chmod(file_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
-        for dir in dirs:
-            dir_path = os.path.join(root, dir)
-            # ディレクトリも読み取り専用に変更
-            os.chmod(dir_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    # ディレクトリ以下をscandirのスタックで走査 (DirEntryの情報を使い余計なstatを避ける)
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    # ディレクトリも読み取り専用に変更
+                    os.chmod(entry.path, _READONLY_DIR_MODE)
+                elif entry.is_symlink() and entry.is_dir():
+                    # ディレクトリへのシンボリックリンクは辿らずに変更のみ行う
+                    os.chmod(entry.path, _READONLY_DIR_MODE)
+                else:
+                    # 読み取り専用に変更
+                    os.chmod(entry.path, _READONLY_FILE_MODE)
+
+def _write_readonly(path, data):
+    # 書き込んだ直後に読み取り専用にし、後からディレクトリを走査し直さない
+    # (os.fchmodはWindowsでは3.13以降にしかないのでcloseしてからchmodする)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0))
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    os.chmod(path, _READONLY_FILE_MODE)
+
+def _copy_readonly(src, dest):
+    shutil.copyfile(src, dest)
+    os.chmod(dest, _READONLY_FILE_MODE)
 
 class EasyExperiment:
     def __init__(self,parent_dir = "experiments",experiment_id = None) -> None:
         self.experiment_id = experiment_id if experiment_id is not None else self.generate_experiment_id()
         self.parent_dir = parent_dir
-        self.save_dir = pathlib.Path(self.parent_dir)/pathlib.Path(self.experiment_id)
-        self.save_dir.mkdir(exist_ok=False)
+        self.save_dir = pathlib.Path(os.path.join(self.parent_dir, self.experiment_id))
+        # 既存なら FileExistsError。parent_dirが無ければ一緒に作成する
+        # (os.makedirsは親ディレクトリの存在確認を行うので、mkdir一回だけにはならない)
+        os.makedirs(self.save_dir, exist_ok=False)
+        self._dir_ready = True
     def generate_experiment_id(self):
         self.experiment_id = str(uuid.uuid4())
         return self.experiment_id
     def generate_experiment_dir(self):
-        self.save_dir.mkdir(parents=True,exist_ok=True)
+        os.makedirs(self.save_dir, exist_ok=True)
+        self._dir_ready = True
     def start_experiment(self,filepath_list = [__file__]):
-        for filepath in filepath_list:
-            # diff = get_file_diff(filepath)
-            hash = get_git_hash()
+        # ハッシュはこの呼び出しの中で一度だけ取得する (MLflowのタグにも使い回す)
+        hash = get_git_hash()
+        self._git_hash = hash
+        # __init__で作成済みなら何もしない (mkdirを毎回発行しない)
+        if not getattr(self, "_dir_ready", False):
             self.generate_experiment_dir()
-            with open(self.save_dir/pathlib.Path("hash"),mode="w") as f:
-                f.write(hash)
-            # with open(self.save_dir/pathlib.Path("diff"),mode="w") as f:
-            #     f.write(diff)
-            with open(filepath,mode="r",encoding="utf-8") as f:
-                source = f.read()
-            name = pathlib.Path(filepath).name
-            with open(self.save_dir/pathlib.Path(name),mode="w") as f:
-                f.write(source)
-        make_readonly_recursive(self.save_dir)
+        save_dir_str = os.fspath(self.save_dir)
+        _write_readonly(os.path.join(save_dir_str, "hash"), hash.encode("utf-8"))
+        # diff = get_file_diff(filepath)
+        # _write_readonly(os.path.join(save_dir_str, "diff"), diff.encode("utf-8"))
+        # 同名のファイルは後に指定したものを優先 (並列コピーで競合させない)
+        copies = {os.path.join(save_dir_str, os.path.basename(filepath)): filepath for filepath in filepath_list}
+        # shutil.copyfileはカーネル内でコピーするのでPythonにデータを読み込まない
+        # コピーしたファイルはその場で読み取り専用にする (make_readonly_recursiveでの再走査は不要)
+        if len(copies) <= 1:
+            for dest, filepath in copies.items():
+                _copy_readonly(filepath, dest)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(copies))) as executor:
+                list(executor.map(_copy_readonly, copies.values(), copies.keys()))
         return self.experiment_id
-    def write_explicit_parms(self,d:dict):
-        with open(self.save_dir/pathlib.Path("prm.json"),mode="w") as f:
-            json.dump(d,f)
+    def write_explicit_parms(self,d:dict,format = "json"):
+        # 大きなパラメータ向けに msgpack / pickle も選べる (既定は prm.json)
+        if format == "json":
+            (self.save_dir/"prm.json").write_bytes(_dumps(d))
+        elif format == "msgpack":
+            import msgpack
+            (self.save_dir/"prm.msgpack").write_bytes(msgpack.packb(d,use_bin_type=True))
+        elif format == "pickle":
+            import pickle
+            (self.save_dir/"prm.pkl").write_bytes(pickle.dumps(d,protocol=pickle.HIGHEST_PROTOCOL))
+        else:
+            raise ValueError(f"format must be 'json', 'msgpack', or 'pickle', got {format!r}")
 
 
 class EasyExperiment2(EasyExperiment):
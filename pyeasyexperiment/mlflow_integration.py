@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import functools
+import io
 import os
 import pathlib
-from typing import Dict, Optional, Union, IO, List
+from typing import Dict, Optional, Union, IO, List, Tuple
+import shutil
 import tempfile
 import sys
 import shlex
@@ -13,12 +16,22 @@ try:
 except Exception:
     psutil = None  # type: ignore
 
-try:
-    import mlflow
-    _MLFLOW_AVAILABLE = True
-except Exception:
-    mlflow = None  # type: ignore
-    _MLFLOW_AVAILABLE = False
+# mlflowはimportが重いので、最初にrunを開始するときまで読み込まない
+mlflow = None  # type: ignore
+_MLFLOW_AVAILABLE: Optional[bool] = None
+
+
+def _get_mlflow():
+    global mlflow, _MLFLOW_AVAILABLE
+    if _MLFLOW_AVAILABLE is None:
+        try:
+            import mlflow as _mlflow
+            mlflow = _mlflow
+            _MLFLOW_AVAILABLE = True
+        except Exception:
+            _MLFLOW_AVAILABLE = False
+    return mlflow
+
 
 from .easy_experiment import (
     EasyExperiment,
@@ -28,6 +41,35 @@ from .easy_experiment import (
 )
 
 
+def _unique_artifact_names(paths: List[str]) -> Dict[str, str]:
+    # basenameが衝突する場合は `name_1.ext` のように連番を付ける
+    names: Dict[str, str] = {}
+    for p in paths:
+        name = os.path.basename(p)
+        if name in names:
+            stem, ext = os.path.splitext(name)
+            i = 1
+            while f"{stem}_{i}{ext}" in names:
+                i += 1
+            name = f"{stem}_{i}{ext}"
+        names[name] = p
+    return names
+
+
+
+@functools.lru_cache(maxsize=1)
+def _default_cmdline() -> Tuple[str, ...]:
+    # プロセスのコマンドラインは起動後に変わらないので一度だけ取得する
+    if psutil is not None:
+        try:
+            cl = psutil.Process().cmdline()  # type: ignore[attr-defined]
+            if cl:
+                return tuple(cl)
+        except Exception:
+            pass
+    exe = sys.executable or "python"
+    return tuple([exe] + list(sys.argv or []))
+
 class _MLflowMixin:
     def __init__(
         self,
@@ -39,7 +81,7 @@ class _MLflowMixin:
         **kwargs,
     ) -> None:
         super().__init__(*args, **kwargs)  # type: ignore[misc]
-        self._mlflow_enabled = mlflow_enabled and _MLFLOW_AVAILABLE
+        self._mlflow_enabled = mlflow_enabled
         self._mlflow_experiment = (
             mlflow_experiment or os.getenv("PYEASYEXPERIMENT_MLFLOW_EXPERIMENT")
         )
@@ -50,10 +92,13 @@ class _MLflowMixin:
         self._mlflow_run_active = False
         self._mlflow_run_id: Optional[str] = None
 
-    def start_mlflow_run(self) -> Optional[str]:
+    def start_mlflow_run(self, git_hash: Optional[str] = None) -> Optional[str]:
         if not self._mlflow_enabled:
             return None
-        assert _MLFLOW_AVAILABLE and mlflow is not None
+        mlflow = _get_mlflow()
+        if mlflow is None:
+            self._mlflow_enabled = False
+            return None
         if self._mlflow_tracking_uri:
             mlflow.set_tracking_uri(self._mlflow_tracking_uri)
         if self._mlflow_experiment:
@@ -63,7 +108,7 @@ class _MLflowMixin:
         self._mlflow_run_id = run.info.run_id
         default_tags = {
             "pyeasyexperiment.experiment_id": str(self.experiment_id),
-            "git.hash": get_git_hash(),
+            "git.hash": git_hash or get_git_hash(),
         }
         if not getattr(self, "_cloud_only", False) and hasattr(self, "save_dir"):
             default_tags["pyeasyexperiment.save_dir"] = str(self.save_dir)
@@ -78,22 +123,32 @@ class _MLflowMixin:
             return
         if not self._mlflow_run_active:
             return
-        assert _MLFLOW_AVAILABLE and mlflow is not None
+        mlflow = _get_mlflow()
+        assert mlflow is not None
         mlflow.end_run()
         self._mlflow_run_active = False
 
     def log_params(self, params: Dict) -> None:
         if not self._MLflowMixin__mlflow_is_on():
             return
-        assert _MLFLOW_AVAILABLE and mlflow is not None
+        mlflow = _get_mlflow()
+        assert mlflow is not None
         mlflow.log_params(params)
 
     def log_metrics(self, metrics: Dict[str, float], step: Optional[int] = None) -> None:
         if not self._MLflowMixin__mlflow_is_on():
             return
-        assert _MLFLOW_AVAILABLE and mlflow is not None
+        mlflow = _get_mlflow()
+        assert mlflow is not None
         mlflow.log_metrics(metrics, step=step)
 
+    def log_artifacts(self, local_dir: str, artifact_path: Optional[str] = None) -> None:
+        if not self._MLflowMixin__mlflow_is_on():
+            return
+        mlflow = _get_mlflow()
+        assert mlflow is not None
+        mlflow.log_artifacts(local_dir, artifact_path=artifact_path)
+
     def log_artifact(
         self,
         path_or_data: Union[str, bytes, bytearray, IO[bytes]],
@@ -102,47 +157,72 @@ class _MLflowMixin:
     ) -> None:
         if not self._MLflowMixin__mlflow_is_on():
             return
-        assert _MLFLOW_AVAILABLE and mlflow is not None
-        if isinstance(path_or_data, str) and os.path.exists(path_or_data):
+        mlflow = _get_mlflow()
+        assert mlflow is not None
+        # メモリ上のデータかどうかを先に判定し、パスの場合だけstatする
+        if not isinstance(path_or_data, (bytes, bytearray)) and not hasattr(path_or_data, "read"):
+            if not isinstance(path_or_data, str):
+                raise TypeError("path_or_data must be a path, bytes, bytearray, or binary file-like object")
+            try:
+                os.stat(path_or_data)
+            except OSError:
+                raise FileNotFoundError(path_or_data) from None
             mlflow.log_artifact(path_or_data, artifact_path=artifact_path)
             return
         if filename is None:
             filename = str(uuid.uuid4())
             raise Warning(f"filename is required when logging binary or file-like data, named {filename}")
+        # 呼び出しごとに独立した一時ディレクトリを使う (同名のfilenameを別スレッドから記録しても衝突しない)
         with tempfile.TemporaryDirectory() as tmpdir:
             tmp_path = os.path.join(tmpdir, filename)
-            os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+            if os.path.dirname(tmp_path) != tmpdir:
+                os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
             if isinstance(path_or_data, (bytes, bytearray)):
-                with open(tmp_path, "wb") as f:
-                    f.write(path_or_data)
-            elif hasattr(path_or_data, "read"):
-                with open(tmp_path, "wb") as f:
-                    f.write(path_or_data.read())  # type: ignore[arg-type]
+                pathlib.Path(tmp_path).write_bytes(memoryview(path_or_data))
+            elif isinstance(path_or_data, io.BytesIO):
+                # BytesIOは内部バッファを読み取り位置からそのまま書き出す (read()によるコピーをしない)
+                pos = path_or_data.tell()
+                pathlib.Path(tmp_path).write_bytes(path_or_data.getbuffer()[pos:])
+                path_or_data.seek(0, io.SEEK_END)
             else:
-                raise TypeError("path_or_data must be a path, bytes, bytearray, or binary file-like object")
+                # 大きなファイルでもメモリに載せきらないよう1MiBずつ書き出す
+                with open(tmp_path, "wb") as f:
+                    shutil.copyfileobj(path_or_data, f, length=1 << 20)  # type: ignore[arg-type]
             mlflow.log_artifact(tmp_path, artifact_path=artifact_path)
 
     def start_experiment(self, filepath_list: List[str] | None = None):  # type: ignore[override]
         exp_id = super().start_experiment(filepath_list or [])
-        self.start_mlflow_run()
+        self.start_mlflow_run(git_hash=getattr(self, "_git_hash", None))
         self.record_run_command()
         return exp_id
 
-    def write_explicit_parms(self, d: Dict):  # type: ignore[override]
-        super().write_explicit_parms(d)
+    def write_explicit_parms(self, d: Dict, format: str = "json"):  # type: ignore[override]
+        super().write_explicit_parms(d, format=format)
         self.log_params(d)
 
     def record_run_command(self, command: Optional[str] = None, env_keys: Optional[List[str]] = None) -> Optional[str]:
+        one_liner, files = self._prepare_run_command(command, env_keys)
+        if files:
+            try:
+                self._log_artifacts_bundle(files)
+            except Exception:
+                pass
+        return one_liner
+
+    def _prepare_run_command(
+        self, command: Optional[str] = None, env_keys: Optional[List[str]] = None
+    ) -> Tuple[Optional[str], Dict[str, Union[bytes, str]]]:
+        # run_command.txt などのアーティファクトは返すだけで、アップロードは呼び出し側でまとめて行う
         cwd = os.getcwd()
-        cmdline_list = self._resolve_cmdline_list()
-        cmd_shell = command or self._build_invocation_command_from_list(cmdline_list)
+        cmd_shell = self._build_invocation_command(command)
         if not cmd_shell:
-            return None
+            return None, {}
         one_liner = f"cd {shlex.quote(cwd)} && {cmd_shell}"
+        one_liner_bytes = one_liner.encode("utf-8")
         try:
             if not getattr(self, "_cloud_only", False) and hasattr(self, "save_dir"):
                 p = pathlib.Path(self.save_dir) / "run_command.txt"
-                p.write_text(one_liner, encoding="utf-8")
+                p.write_bytes(one_liner_bytes)
         except Exception:
             pass
         try:
@@ -156,32 +236,39 @@ class _MLflowMixin:
             )
         except Exception:
             pass
-        try:
-            self.log_artifact(one_liner.encode("utf-8"), filename="run_command.txt")
-        except Exception:
-            pass
+        files: Dict[str, Union[bytes, str]] = {"run_command.txt": one_liner_bytes}
         if env_keys:
-            try:
-                lines = []
-                for k in env_keys:
-                    v = os.getenv(k, "")
-                    lines.append(f"{k}={v}")
-                env_txt = "\n".join(lines).encode("utf-8")
-                self.log_artifact(env_txt, filename="run_env_subset.txt")
-            except Exception:
-                pass
-        return one_liner
+            lines = []
+            for k in env_keys:
+                v = os.getenv(k, "")
+                lines.append(f"{k}={v}")
+            files["run_env_subset.txt"] = "\n".join(lines).encode("utf-8")
+        return one_liner, files
+
+    def _log_artifacts_bundle(self, files: Dict[str, Union[bytes, str]], artifact_path: Optional[str] = None) -> None:
+        # bytesはそのまま書き込み、strはローカルファイルのパスとしてコピーして一度にアップロードする
+        if not files or not self._MLflowMixin__mlflow_is_on():
+            return
+        with tempfile.TemporaryDirectory() as tmpdir:
+            staged = 0
+            for name, data in files.items():
+                # 読めないファイルなどは個別に飛ばし、残りのアップロードは続ける
+                try:
+                    dest = os.path.join(tmpdir, name)
+                    if os.path.dirname(dest) != tmpdir:
+                        os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    if isinstance(data, (bytes, bytearray)):
+                        pathlib.Path(dest).write_bytes(data)
+                    else:
+                        shutil.copyfile(data, dest)
+                except OSError:
+                    continue
+                staged += 1
+            if staged:
+                self.log_artifacts(tmpdir, artifact_path=artifact_path)
 
     def _resolve_cmdline_list(self) -> List[str]:
-        if psutil is not None:
-            try:
-                cl = psutil.Process().cmdline()  # type: ignore[attr-defined]
-                if cl:
-                    return cl
-            except Exception:
-                pass
-        exe = sys.executable or "python"
-        return [exe] + list(sys.argv or [])
+        return list(_default_cmdline())
 
     def _build_invocation_command_from_list(self, cmdline_list: List[str]) -> str:
         try:
@@ -202,7 +289,7 @@ class _MLflowMixin:
         return self._build_invocation_command_from_list(self._resolve_cmdline_list())
 
     def _MLflowMixin__mlflow_is_on(self) -> bool:
-        return self._mlflow_enabled and self._mlflow_run_active and _MLFLOW_AVAILABLE
+        return self._mlflow_enabled and self._mlflow_run_active
 
 
 class MLflowExperiment(_MLflowMixin, EasyExperiment):
@@ -221,7 +308,7 @@ class MLflowExperiment2(_MLflowMixin, EasyExperiment2):
     ) -> None:
         self._cloud_only = True
         self.experiment_id = experiment_id or str(uuid.uuid4())
-        self._mlflow_enabled = mlflow_enabled and _MLFLOW_AVAILABLE
+        self._mlflow_enabled = mlflow_enabled
         self._mlflow_experiment = (
             mlflow_experiment or os.getenv("PYEASYEXPERIMENT_MLFLOW_EXPERIMENT")
         )
@@ -239,20 +326,20 @@ class MLflowExperiment2(_MLflowMixin, EasyExperiment2):
             git_commit_all_unstaged(commit_message)
         except Exception:
             pass
-        self.start_mlflow_run()
+        gh = get_git_hash()
+        self.start_mlflow_run(git_hash=gh)
+        # git_hash.txt・ソース・run_command.txt を一つのディレクトリにまとめて一度にアップロードする
+        files: Dict[str, Union[bytes, str]] = {"git_hash.txt": gh.encode("utf-8")}
+        sources = [p for p in filepath_list or [] if isinstance(p, str) and os.path.isfile(p)]
+        for name, p in _unique_artifact_names(sources).items():
+            files[f"source/{name}"] = p
+        _, run_files = self._prepare_run_command()
+        files.update(run_files)
         try:
-            gh = get_git_hash()
-            self.log_artifact(gh.encode("utf-8"), filename="git_hash.txt")
+            self._log_artifacts_bundle(files)
         except Exception:
             pass
-        for p in filepath_list or []:
-            try:
-                if isinstance(p, str) and os.path.exists(p):
-                    self.log_artifact(p, artifact_path="source")
-            except Exception:
-                continue
-        self.record_run_command()
         return str(self.experiment_id)
 
-    def write_explicit_parms(self, d: Dict):  # type: ignore[override]
+    def write_explicit_parms(self, d: Dict, format: str = "json"):  # type: ignore[override]
         self.log_params(d)